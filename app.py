@@ -5,41 +5,148 @@ Monitors Gmail for specific emails and posts them to Slack.
 """
 
 import os
+import asyncio
 import base64
 import sqlite3
 import logging
+import queue
+import atexit
 import threading
 import time
+import random
 import re
 import hashlib
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, Any, List, Optional
+from logging.handlers import QueueHandler, QueueListener
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, List, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-from flask import Flask, jsonify
-from waitress import serve
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
 
-from google.auth.transport.requests import Request
+import httplib2
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-import pytz
-import requests
+import httpx
+import orjson
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
 # Load environment variables
 load_dotenv('config.env')
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configure logging: records are handed to a queue and written to stderr by a
+# background listener, so polling and request handling never block on log I/O
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logging.basicConfig(level=logging.DEBUG, format='%(message)s', handlers=[QueueHandler(_log_queue)])
+log_listener = QueueListener(_log_queue, _log_stream_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Gmail API scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+# Delegated credentials shared across monitor instances, keyed by a hash of the account identity
+_CREDENTIALS_CACHE: Dict[str, Any] = {}
+
+# Timeout for Gmail API HTTP calls
+GMAIL_HTTP_TIMEOUT = 30
+
+# Gmail caps batch requests at 100 sub-requests per HTTP call
+GMAIL_BATCH_LIMIT = 100
+
+# Maximum number of processed message IDs kept in the in-memory LRU cache
+SEEN_CACHE_SIZE = 4096
+
+# Processed rows older than this are purged (well past the newer_than:7d query window)
+PROCESSED_RETENTION_DAYS = 30
+PURGE_INTERVAL_SECONDS = 3600
+
+# Gmail API statuses retried with exponential backoff instead of the normal poll interval
+RETRYABLE_HTTP_STATUSES = {429, 500, 503}
+MIN_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 64.0
+
+# Length of the Slack body preview when RETURN_FULL_BODY is false
+BODY_PREVIEW_LIMIT = 200
+
+# Display format for email dates; also feeds the fallback dedup hash, so keep it stable
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+class AuthorizedSessionHttp:
+    """httplib2.Http-compatible transport that sends Gmail API calls over a pooled AuthorizedSession."""
+    
+    def __init__(self, credentials, timeout: float = GMAIL_HTTP_TIMEOUT):
+        # googleapiclient looks for this attribute to authorize batch requests
+        self.credentials = credentials
+        self.timeout = timeout
+        self.session = AuthorizedSession(credentials)
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        """Perform a request and return an (httplib2.Response, bytes) pair like httplib2.Http.request."""
+        response = self.session.request(method, uri, data=body, headers=headers, timeout=self.timeout)
+        # requests has already decoded the body, so drop the encoding header as httplib2 does
+        info = {k: v for k, v in response.headers.items() if k.lower() != 'content-encoding'}
+        info['status'] = str(response.status_code)
+        # The decoded body no longer matches the wire length, and the batch response parser needs a true length
+        info['content-length'] = str(len(response.content))
+        return httplib2.Response(info), response.content
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (delay in seconds or an HTTP date) into seconds from now."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def html_to_text(html: str) -> str:
+    """Convert HTML to plain text, using selectolax when it is installed."""
+    if LexborHTMLParser is not None:
+        tree = LexborHTMLParser(html)
+        if tree.body is not None:
+            return tree.body.text(separator='')
+    # Simple HTML to text conversion
+    return _HTML_TAG_RE.sub('', html)
+
 class GmailSlackMonitor:
     """Monitor Gmail for specific emails and post to Slack."""
     
+    # SQL kept as fixed literals so every call hits the connection's statement cache
+    _SQL_CHECK = 'SELECT EXISTS(SELECT 1 FROM processed WHERE id = ? LIMIT 1)'
+    _SQL_CHECK_RECORD_ID = 'SELECT EXISTS(SELECT 1 FROM processed WHERE record_id = ? LIMIT 1)'
+    _SQL_CHECK_FALLBACK_HASH = 'SELECT EXISTS(SELECT 1 FROM processed WHERE fallback_hash = ? LIMIT 1)'
+    _SQL_BULK_CHECK = 'SELECT id FROM processed WHERE id IN ({placeholders})'
+    _SQL_INSERT = 'INSERT OR IGNORE INTO processed (id, record_id, fallback_hash) VALUES (?, ?, ?)'
+    _SQL_DELETE = 'DELETE FROM processed WHERE id = ?'
+    _SQL_PURGE = "DELETE FROM processed WHERE ts < datetime('now', ?)"
+    
     def __init__(self):
         """Initialize the monitor with configuration from environment variables."""
         self.gmail_query = os.getenv('GMAIL_QUERY', 'from:noreply@forthcrm.com (subject:"Cancellation" OR subject:"Cancel" OR subject:"cancelled" OR subject:"cancelled") newer_than:7d')
@@ -52,12 +159,36 @@ class GmailSlackMonitor:
         
         # Initialize timezone
         try:
-            self.tz = pytz.timezone(self.timezone)
-        except pytz.exceptions.UnknownTimeZoneError:
+            self.tz = ZoneInfo(self.timezone)
+        except (ZoneInfoNotFoundError, ValueError):
             logger.warning(f"Unknown timezone: {self.timezone}, using UTC")
-            self.tz = pytz.UTC
+            self.tz = ZoneInfo('UTC')
+        
+        # Pooled keep-alive client for Slack webhook posts, owned by start_polling_async
+        self._slack_client = None
+        
+        # Static parts of every Slack payload, built once
+        self._slack_base = {
+            "channel": self.slack_channel,
+            "username": self.slack_username
+        }
+        self._query_block = {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"*Query:* `{self.gmail_query}`"
+            }
+        }
+        
+        # Backoff state for retryable Gmail API errors
+        self._backoff = MIN_BACKOFF_SECONDS
+        self._retry_pending = False
+        self._retry_after = None
+        self._poll_succeeded = False
         
-        # Initialize database
+        # Initialize database and the in-memory cache of processed message IDs
+        self._seen_cache = OrderedDict()
+        self._last_purge = 0.0
         self.init_database()
         
         # Initialize Gmail service (with error handling)
@@ -82,15 +213,24 @@ class GmailSlackMonitor:
         """Initialize SQLite database for tracking processed messages."""
         try:
             db_path = self.get_db_path()
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
+            # Keep a single connection open for the lifetime of the monitor;
+            # it is shared by the event loop and the worker threads it dispatches to.
+            self._db = sqlite3.connect(
+                db_path, check_same_thread=False, isolation_level=None, cached_statements=256
+            )
+            self._db_lock = threading.Lock()
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('PRAGMA temp_store=MEMORY')
+            self._db.execute('PRAGMA cache_size=-64000')
+            cursor = self._db.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS processed (
                     id TEXT PRIMARY KEY,
                     record_id TEXT,
                     fallback_hash TEXT,
                     ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
+                ) WITHOUT ROWID
             ''')
             # Create indexes for faster lookups
             cursor.execute('''
@@ -99,13 +239,28 @@ class GmailSlackMonitor:
             cursor.execute('''
                 CREATE INDEX IF NOT EXISTS idx_fallback_hash ON processed(fallback_hash)
             ''')
-            conn.commit()
-            conn.close()
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_ts ON processed(ts)
+            ''')
             logger.info(f"Database initialized successfully at {db_path}")
         except Exception as e:
             logger.error(f"Failed to initialize database: {e}")
             raise
 
+    def purge_old_processed(self):
+        """Delete processed rows older than the retention window, at most once per interval."""
+        now = time.monotonic()
+        if self._last_purge and now - self._last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        try:
+            with self._db_lock:
+                cursor = self._db.execute(self._SQL_PURGE, (f'-{PROCESSED_RETENTION_DAYS} days',))
+            self._last_purge = now
+            if cursor.rowcount:
+                logger.info(f"Purged {cursor.rowcount} processed records older than {PROCESSED_RETENTION_DAYS} days")
+        except Exception as e:
+            logger.error(f"Error purging old processed records: {e}")
+
     def extract_record_id(self, body: str) -> Optional[str]:
         """Extract Record ID from email body using multiple patterns."""
         try:
@@ -151,13 +306,9 @@ class GmailSlackMonitor:
         if not record_id:
             return False
         try:
-            db_path = self.get_db_path()
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT record_id FROM processed WHERE record_id = ?', (record_id,))
-            result = cursor.fetchone()
-            conn.close()
-            return result is not None
+            with self._db_lock:
+                row = self._db.execute(self._SQL_CHECK_RECORD_ID, (record_id,)).fetchone()
+            return row[0] == 1
         except Exception as e:
             logger.error(f"Error checking if record ID is processed: {e}")
             return False
@@ -167,13 +318,9 @@ class GmailSlackMonitor:
         if not fallback_hash:
             return False
         try:
-            db_path = self.get_db_path()
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT fallback_hash FROM processed WHERE fallback_hash = ?', (fallback_hash,))
-            result = cursor.fetchone()
-            conn.close()
-            return result is not None
+            with self._db_lock:
+                row = self._db.execute(self._SQL_CHECK_FALLBACK_HASH, (fallback_hash,)).fetchone()
+            return row[0] == 1
         except Exception as e:
             logger.error(f"Error checking if fallback hash is processed: {e}")
             return False
@@ -192,7 +339,7 @@ class GmailSlackMonitor:
             logger.info("Service Account credentials with delegation loaded successfully")
             
             # Build Gmail service with Service Account credentials
-            self.gmail_service = build('gmail', 'v1', credentials=creds)
+            self.gmail_service = build('gmail', 'v1', http=AuthorizedSessionHttp(creds))
             logger.info("Gmail service initialized successfully with Service Account")
             
         except Exception as e:
@@ -252,6 +399,16 @@ class GmailSlackMonitor:
                 if not service_account_info.get(field):
                     raise ValueError(f"Missing required field: {field}")
             
+            # Reuse credentials (and their access token) from an earlier monitor until they expire
+            cache_key = hashlib.sha256(
+                f"{service_account_info['client_email']}|{service_account_info['private_key_id']}|"
+                f"{delegated_email}|{private_key}".encode('utf-8')
+            ).hexdigest()
+            cached_creds = _CREDENTIALS_CACHE.get(cache_key)
+            if cached_creds is not None and not cached_creds.expired:
+                logger.info(f"Reusing cached Service Account credentials for {delegated_email}")
+                return cached_creds
+            
             # Create credentials with delegation
             creds = service_account.Credentials.from_service_account_info(
                 service_account_info, scopes=SCOPES
@@ -259,6 +416,7 @@ class GmailSlackMonitor:
             
             # Create delegated credentials
             delegated_creds = creds.with_subject(delegated_email)
+            _CREDENTIALS_CACHE[cache_key] = delegated_creds
             
             logger.info(f"Service Account credentials with delegation loaded for {delegated_email}")
             return delegated_creds
@@ -290,162 +448,335 @@ class GmailSlackMonitor:
             logger.error(f"Failed to load Service Account credentials with delegation from file: {e}")
             raise
 
-    def poll_gmail(self):
-        """Poll Gmail for new messages matching the query."""
-        try:
-            # Check if Gmail service is available
-            if not self.gmail_service:
-                logger.warning("Gmail service not initialized, attempting to reinitialize...")
-                try:
-                    self.init_gmail_service()
-                except Exception as e:
-                    logger.error(f"Failed to reinitialize Gmail service: {e}")
-                    return
-            
-            logger.info(f"Polling Gmail with query: {self.gmail_query}")
-            
-            # Search for messages
-            results = self.gmail_service.users().messages().list(
-                userId='me', 
-                q=self.gmail_query,
-                maxResults=50
-            ).execute()
-            
-            messages = results.get('messages', [])
-            logger.info(f"Found {len(messages)} messages matching query")
-            
-            new_messages = 0
-            skipped_by_message_id = 0
-            skipped_by_record_id = 0
-            skipped_by_fallback = 0
-            
-            for message in messages:
-                message_id = message['id']
-                logger.debug(f"Processing message ID: {message_id}")
-                
-                # Check if already processed by message ID
-                if self.is_message_processed(message_id):
-                    logger.debug(f"Skipping message {message_id} - already processed by message ID")
-                    skipped_by_message_id += 1
-                    continue
-                
-                # Get message details
-                message_data = self.get_message_details(message_id)
-                if not message_data:
-                    logger.warning(f"Failed to get message details for {message_id}")
+    def collect_new_messages(self) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, int]]]:
+        """Fetch matching messages and return those that still need to be posted to Slack.
+
+        Returns a list of pending posts (message ID, message data, record ID, fallback hash)
+        together with the skip counters, or None if the Gmail service is unavailable.
+        """
+        # Check if Gmail service is available
+        if not self.gmail_service:
+            logger.warning("Gmail service not initialized, attempting to reinitialize...")
+            try:
+                self.init_gmail_service()
+            except Exception as e:
+                logger.error(f"Failed to reinitialize Gmail service: {e}")
+                return None
+        
+        self.purge_old_processed()
+        
+        logger.info(f"Polling Gmail with query: {self.gmail_query}")
+        
+        # Search for messages
+        results = self.gmail_service.users().messages().list(
+            userId='me', 
+            q=self.gmail_query,
+            maxResults=50
+        ).execute()
+        
+        messages = results.get('messages', [])
+        logger.info(f"Found {len(messages)} messages matching query")
+        
+        skipped = {'message_id': 0, 'record_id': 0, 'fallback': 0}
+        to_post = []
+        # Identifiers queued for posting in this poll, so duplicates within one poll are caught
+        queued_record_ids = set()
+        queued_fallback_hashes = set()
+        
+        # Filter out messages already processed by message ID with one bulk lookup
+        message_ids = [message['id'] for message in messages]
+        processed_ids = self.get_processed_message_ids(message_ids)
+        pending_ids = [message_id for message_id in message_ids if message_id not in processed_ids]
+        skipped['message_id'] = len(message_ids) - len(pending_ids)
+        
+        # Fetch details for all remaining messages in batched requests
+        details = self.get_message_details_batch(pending_ids)
+        
+        for message_id in pending_ids:
+            logger.debug(f"Processing message ID: {message_id}")
+            
+            message_data = details.get(message_id)
+            if not message_data:
+                logger.warning(f"Failed to get message details for {message_id}")
+                continue
+            
+            logger.debug(f"Processing email: {message_data.get('subject', 'No Subject')} from {message_data.get('sender', 'Unknown')}")
+            
+            # Extract record ID from email body
+            record_id = self.extract_record_id(message_data.get('body', ''))
+            logger.debug(f"Extracted Record ID: {record_id if record_id else 'None'}")
+            
+            # DUAL-LAYER DEDUPLICATION SYSTEM
+            # Duplicates of a message queued in this poll are left unmarked, so they are
+            # re-checked on the next poll in case that post fails
+            # Layer 1: Record ID deduplication (primary)
+            if record_id and record_id in queued_record_ids:
+                logger.info(f"Skipping duplicate record ID: {record_id} for message {message_id} (already queued)")
+                skipped['record_id'] += 1
+                continue
+            if record_id and self.is_duplicate_by_record_id(record_id):
+                logger.info(f"Skipping duplicate record ID: {record_id} for message {message_id}")
+                # Mark message as processed to avoid re-checking
+                self.mark_message_processed(message_id, record_id)
+                skipped['record_id'] += 1
+                continue
+            
+            # Layer 2: Fallback deduplication (when no Record ID)
+            if not record_id:
+                fallback_hash = self.generate_fallback_hash(
+                    message_data.get('subject', ''), 
+                    message_data.get('date', '')
+                )
+                logger.debug(f"Generated fallback hash: {fallback_hash}")
+                if fallback_hash and fallback_hash in queued_fallback_hashes:
+                    logger.info(f"Skipping duplicate fallback hash: {fallback_hash} for message {message_id} (already queued)")
+                    skipped['fallback'] += 1
                     continue
-                
-                logger.debug(f"Processing email: {message_data.get('subject', 'No Subject')} from {message_data.get('sender', 'Unknown')}")
-                
-                # Extract record ID from email body
-                record_id = self.extract_record_id(message_data.get('body', ''))
-                logger.debug(f"Extracted Record ID: {record_id if record_id else 'None'}")
-                
-                # DUAL-LAYER DEDUPLICATION SYSTEM
-                # Layer 1: Record ID deduplication (primary)
-                if record_id and self.is_duplicate_by_record_id(record_id):
-                    logger.info(f"Skipping duplicate record ID: {record_id} for message {message_id}")
+                if fallback_hash and self.is_duplicate_by_fallback_hash(fallback_hash):
+                    logger.info(f"Skipping duplicate fallback hash: {fallback_hash} for message {message_id}")
                     # Mark message as processed to avoid re-checking
-                    self.mark_message_processed(message_id, record_id)
-                    skipped_by_record_id += 1
+                    self.mark_message_processed(message_id, None, fallback_hash)
+                    skipped['fallback'] += 1
                     continue
-                
-                # Layer 2: Fallback deduplication (when no Record ID)
-                if not record_id:
-                    fallback_hash = self.generate_fallback_hash(
-                        message_data.get('subject', ''), 
-                        message_data.get('date', '')
-                    )
-                    logger.debug(f"Generated fallback hash: {fallback_hash}")
-                    if fallback_hash and self.is_duplicate_by_fallback_hash(fallback_hash):
-                        logger.info(f"Skipping duplicate fallback hash: {fallback_hash} for message {message_id}")
-                        # Mark message as processed to avoid re-checking
-                        self.mark_message_processed(message_id, None, fallback_hash)
-                        skipped_by_fallback += 1
-                        continue
-                else:
-                    fallback_hash = None
-                
-                # Post to Slack
-                logger.info(f"Posting new message to Slack: {message_data['subject']}")
-                if self.post_to_slack(message_data):
-                    # Mark as processed with all available identifiers
-                    self.mark_message_processed(message_id, record_id, fallback_hash)
-                    new_messages += 1
-                    logger.info(f"✅ Successfully posted to Slack: {message_data['subject']} (Record ID: {record_id}, Fallback: {fallback_hash})")
-                else:
-                    logger.error(f"❌ Failed to post message to Slack: {message_data['subject']}")
+            else:
+                fallback_hash = None
+            
+            if record_id:
+                queued_record_ids.add(record_id)
+            else:
+                queued_fallback_hashes.add(fallback_hash)
+            
+            to_post.append({
+                'message_id': message_id,
+                'message_data': message_data,
+                'record_id': record_id,
+                'fallback_hash': fallback_hash
+            })
+        
+        return to_post, skipped
+
+    def _record_post_result(self, item: Dict[str, Any], posted: bool) -> bool:
+        """Log the outcome of a Slack post, releasing the message's claim unless it was posted."""
+        message_data = item['message_data']
+        if posted:
+            logger.info(f"✅ Successfully posted to Slack: {message_data['subject']} (Record ID: {item['record_id']}, Fallback: {item['fallback_hash']})")
+        else:
+            logger.error(f"❌ Failed to post message to Slack: {message_data['subject']}")
+            # Release the claim so the message is retried on the next poll
+            self.release_message(item['message_id'])
+        return posted
+
+    def _log_poll_results(self, new_messages: int, skipped: Dict[str, int]):
+        """Log the summary line for a completed poll."""
+        logger.info(f"Polling complete. Results: {new_messages} new messages posted, {skipped['message_id']} skipped by message ID, {skipped['record_id']} skipped by record ID, {skipped['fallback']} skipped by fallback hash")
+
+    def poll_gmail(self):
+        """Poll Gmail once from synchronous code, such as the helper scripts."""
+        asyncio.run(self.poll_gmail_async())
+
+    async def poll_gmail_async(self):
+        """Poll Gmail for new messages without blocking the event loop and post them to Slack."""
+        self._poll_succeeded = False
+        try:
+            # Gmail API client is blocking, so run it off the event loop
+            collected = await asyncio.to_thread(self.collect_new_messages)
+            if collected is None:
+                return
+            to_post, skipped = collected
+            
+            if self._slack_client is not None:
+                new_messages = await self._post_messages(self._slack_client, to_post, skipped)
+            else:
+                # Outside the worker loop (e.g. /sweep in server mode), use a client for this poll only
+                async with self._new_slack_client() as client:
+                    new_messages = await self._post_messages(client, to_post, skipped)
             
-            logger.info(f"Polling complete. Results: {new_messages} new messages posted, {skipped_by_message_id} skipped by message ID, {skipped_by_record_id} skipped by record ID, {skipped_by_fallback} skipped by fallback hash")
+            self._log_poll_results(new_messages, skipped)
+            self._poll_succeeded = True
             
+        except HttpError as e:
+            self._handle_poll_http_error(e)
         except Exception as e:
             logger.error(f"Error during Gmail polling: {e}")
 
+    async def _post_messages(self, client: httpx.AsyncClient, to_post: List[Dict[str, Any]],
+                             skipped: Dict[str, int]) -> int:
+        """Claim and post pending messages to Slack, returning how many were posted."""
+        # Post one at a time, in order: Slack rate-limits incoming webhooks to about one message per second
+        new_messages = 0
+        for item in to_post:
+            # Claim right before posting so a concurrent poll or a restart cannot post it twice
+            if not self.claim_message(item['message_id'], item['record_id'], item['fallback_hash']):
+                logger.debug(f"Skipping message {item['message_id']} - already claimed by another poll")
+                skipped['message_id'] += 1
+                continue
+            posted = False
+            try:
+                logger.info(f"Posting new message to Slack: {item['message_data']['subject']}")
+                posted = await self.post_to_slack_async(client, item['message_data'])
+            finally:
+                # Anything but a confirmed post, including cancellation, releases the claim
+                if self._record_post_result(item, posted):
+                    new_messages += 1
+        return new_messages
+
+    def _handle_poll_http_error(self, error: HttpError):
+        """Log a Gmail API error from polling and flag retryable ones for backoff."""
+        logger.error(f"Gmail API error during polling: {error}")
+        self._note_retryable_error(error)
+
+    def _note_retryable_error(self, error: HttpError) -> bool:
+        """Flag the next poll for backoff if the error is retryable, keeping any Retry-After hint."""
+        if error.resp.status not in RETRYABLE_HTTP_STATUSES:
+            return False
+        self._retry_pending = True
+        retry_after = parse_retry_after(error.resp.get('retry-after'))
+        if retry_after is not None:
+            self._retry_after = max(self._retry_after or 0.0, retry_after)
+        return True
+
+    def _next_poll_delay(self) -> float:
+        """Return seconds to wait before the next poll, applying exponential backoff after retryable errors."""
+        if self._retry_pending:
+            self._retry_pending = False
+            # Never poll sooner than usual while throttled; honor Retry-After when it asks for longer
+            delay = self.poll_interval + self._backoff + random.random()
+            if self._retry_after is not None:
+                delay = max(delay, self._retry_after)
+                self._retry_after = None
+            self._backoff = min(self._backoff * 2, MAX_BACKOFF_SECONDS)
+            logger.warning(f"Gmail API throttled or unavailable, retrying in {delay:.1f} seconds")
+            return delay
+        # Step down only after a clean poll, not after other errors or a skipped poll
+        if self._poll_succeeded:
+            self._backoff = max(self._backoff / 2, MIN_BACKOFF_SECONDS)
+        return self.poll_interval
+
     def is_message_processed(self, message_id: str) -> bool:
         """Check if a message has already been processed."""
         try:
-            db_path = self.get_db_path()
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT id FROM processed WHERE id = ?', (message_id,))
-            result = cursor.fetchone()
-            conn.close()
-            return result is not None
+            with self._db_lock:
+                if message_id in self._seen_cache:
+                    self._seen_cache.move_to_end(message_id)
+                    return True
+                row = self._db.execute(self._SQL_CHECK, (message_id,)).fetchone()
+                if row[0] == 1:
+                    self._remember_processed(message_id)
+                    return True
+            return False
         except Exception as e:
             logger.error(f"Error checking if message is processed: {e}")
             return False
 
+    def get_processed_message_ids(self, message_ids: List[str]) -> set:
+        """Return the subset of message IDs that have already been processed."""
+        if not message_ids:
+            return set()
+        try:
+            with self._db_lock:
+                processed = set()
+                misses = []
+                for message_id in message_ids:
+                    if message_id in self._seen_cache:
+                        self._seen_cache.move_to_end(message_id)
+                        processed.add(message_id)
+                    else:
+                        misses.append(message_id)
+                if misses:
+                    placeholders = ','.join('?' * len(misses))
+                    rows = self._db.execute(
+                        self._SQL_BULK_CHECK.format(placeholders=placeholders), misses
+                    ).fetchall()
+                    for row in rows:
+                        self._remember_processed(row[0])
+                        processed.add(row[0])
+            return processed
+        except Exception as e:
+            logger.error(f"Error checking processed message IDs: {e}")
+            return set()
+
     def mark_message_processed(self, message_id: str, record_id: str = None, fallback_hash: str = None):
         """Mark a message as processed with message ID, record ID, and fallback hash."""
         try:
-            db_path = self.get_db_path()
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute('INSERT OR IGNORE INTO processed (id, record_id, fallback_hash) VALUES (?, ?, ?)', 
-                          (message_id, record_id, fallback_hash))
-            conn.commit()
-            conn.close()
+            with self._db_lock:
+                self._db.execute(self._SQL_INSERT, (message_id, record_id, fallback_hash))
+                self._remember_processed(message_id)
         except Exception as e:
             logger.error(f"Error marking message as processed: {e}")
 
+    def claim_message(self, message_id: str, record_id: str = None, fallback_hash: str = None) -> bool:
+        """Atomically mark a message as processed before posting; return False if it was already claimed."""
+        try:
+            with self._db_lock:
+                cursor = self._db.execute(self._SQL_INSERT, (message_id, record_id, fallback_hash))
+                if cursor.rowcount == 1:
+                    self._remember_processed(message_id)
+                    return True
+            return False
+        except Exception as e:
+            logger.error(f"Error claiming message: {e}")
+            return False
+
+    def release_message(self, message_id: str):
+        """Remove a claimed message so it can be retried."""
+        try:
+            with self._db_lock:
+                self._db.execute(self._SQL_DELETE, (message_id,))
+                self._seen_cache.pop(message_id, None)
+        except Exception as e:
+            logger.error(f"Error releasing message claim: {e}")
+
+    def _remember_processed(self, message_id: str):
+        """Add a processed message ID to the LRU cache. Caller must hold _db_lock."""
+        self._seen_cache[message_id] = True
+        self._seen_cache.move_to_end(message_id)
+        while len(self._seen_cache) > SEEN_CACHE_SIZE:
+            self._seen_cache.popitem(last=False)
+
+    def _message_get_request(self, message_id: str):
+        """Build the Gmail API request for a single message, fetching only the fields we use."""
+        # MIME parts are always needed: the Record ID is extracted from the full body
+        return self.gmail_service.users().messages().get(
+            userId='me', 
+            id=message_id,
+            format='full',
+            fields='id,threadId,snippet,payload(headers,mimeType,body/data,parts)'
+        )
+
+    def get_message_details_batch(self, message_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Get details for many messages using Gmail batch requests, keyed by message ID."""
+        details = {}
+        
+        def on_message_fetched(request_id, response, exception):
+            if exception is not None:
+                logger.error(f"Gmail API error for message {request_id}: {exception}")
+                if isinstance(exception, HttpError):
+                    self._note_retryable_error(exception)
+                return
+            try:
+                details[request_id] = self.parse_message(response)
+            except Exception as e:
+                logger.error(f"Error getting message details for {request_id}: {e}")
+        
+        for start in range(0, len(message_ids), GMAIL_BATCH_LIMIT):
+            batch = self.gmail_service.new_batch_http_request(callback=on_message_fetched)
+            for message_id in message_ids[start:start + GMAIL_BATCH_LIMIT]:
+                batch.add(self._message_get_request(message_id), request_id=message_id)
+            try:
+                batch.execute()
+            except HttpError as e:
+                # Throttling or server errors on the batch call itself must reach the poll's backoff handling
+                if e.resp.status in RETRYABLE_HTTP_STATUSES:
+                    raise
+                logger.error(f"Gmail API batch error: {e}")
+        
+        return details
+
     def get_message_details(self, message_id: str) -> Optional[Dict[str, Any]]:
         """Get detailed information about a specific message."""
         try:
-            message = self.gmail_service.users().messages().get(
-                userId='me', 
-                id=message_id,
-                format='full'
-            ).execute()
-            
-            payload = message['payload']
-            headers = payload.get('headers', [])
-            
-            # Extract headers
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-            sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
-            date_str = next((h['value'] for h in headers if h['name'] == 'Date'), '')
-            
-            # Parse and format date
-            try:
-                from email.utils import parsedate_to_datetime
-                dt = parsedate_to_datetime(date_str)
-                if self.tz:
-                    dt = dt.astimezone(self.tz)
-                formatted_date = dt.strftime('%Y-%m-%d %H:%M:%S %Z')
-            except:
-                formatted_date = date_str
-            
-            # Extract body
-            body = self.extract_message_body(payload)
-            
-            return {
-                'subject': subject,
-                'sender': sender,
-                'date': formatted_date,
-                'body': body,
-                'thread_id': message.get('threadId', ''),
-                'snippet': message.get('snippet', '')
-            }
+            message = self._message_get_request(message_id).execute()
+            return self.parse_message(message)
             
         except HttpError as e:
             logger.error(f"Gmail API error for message {message_id}: {e}")
@@ -454,139 +785,156 @@ class GmailSlackMonitor:
             logger.error(f"Error getting message details for {message_id}: {e}")
             return None
 
-    def extract_message_body(self, payload: Dict[str, Any]) -> str:
-        """Extract text body from email payload."""
-        body = ""
+    def parse_message(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Extract subject, sender, date and body from a Gmail message resource."""
+        payload = message['payload']
+        headers = payload.get('headers', [])
         
-        def extract_from_part(part):
-            if part.get('mimeType') == 'text/plain':
-                data = part.get('body', {}).get('data', '')
-                if data:
-                    try:
-                        return base64.urlsafe_b64decode(data).decode('utf-8')
-                    except Exception:
-                        return ""
-            elif part.get('mimeType') == 'text/html':
-                data = part.get('body', {}).get('data', '')
-                if data:
-                    try:
-                        html = base64.urlsafe_b64decode(data).decode('utf-8')
-                        # Simple HTML to text conversion
-                        text = re.sub(r'<[^>]+>', '', html)
-                        return text
-                    except Exception:
-                        return ""
-            elif 'parts' in part:
-                for subpart in part['parts']:
-                    result = extract_from_part(subpart)
-                    if result:
-                        return result
-            return ""
+        # Extract headers in a single pass, keeping the first match of each and
+        # stopping once all three are found
+        subject = sender = date_str = None
+        for h in headers:
+            name = h['name']
+            if subject is None and name in ('Subject', 'subject'):
+                subject = h['value']
+            elif sender is None and name in ('From', 'from'):
+                sender = h['value']
+            elif date_str is None and name in ('Date', 'date'):
+                date_str = h['value']
+            else:
+                continue
+            if subject is not None and sender is not None and date_str is not None:
+                break
+        if subject is None:
+            subject = 'No Subject'
+        if sender is None:
+            sender = 'Unknown Sender'
+        if date_str is None:
+            date_str = ''
+        
+        # Parse and format date
+        try:
+            dt = parsedate_to_datetime(date_str)
+            if self.tz:
+                dt = dt.astimezone(self.tz)
+            formatted_date = dt.strftime(DATE_FORMAT)
+        except:
+            formatted_date = date_str
+        
+        # Extract body
+        body = self.extract_message_body(payload)
         
-        # Check if this is a simple text/plain message
-        if payload.get('mimeType') == 'text/plain':
-            data = payload.get('body', {}).get('data', '')
+        return {
+            'subject': subject,
+            'sender': sender,
+            'date': formatted_date,
+            'body': body,
+            'thread_id': message.get('threadId', ''),
+            'snippet': message.get('snippet', '')
+        }
+
+    def extract_message_body(self, payload: Dict[str, Any]) -> str:
+        """Extract text body from email payload."""
+        body = self._extract_from_part(payload)
+        return body or payload.get('snippet', '')
+
+    def _extract_from_part(self, part: Dict[str, Any]) -> str:
+        """Return the first text/plain or text/html body found in a MIME part tree."""
+        mime_type = part.get('mimeType')
+        if mime_type == 'text/plain':
+            data = part.get('body', {}).get('data', '')
             if data:
                 try:
                     return base64.urlsafe_b64decode(data).decode('utf-8')
                 except Exception:
-                    pass
-        
-        # Check if this is a simple text/html message
-        elif payload.get('mimeType') == 'text/html':
-            data = payload.get('body', {}).get('data', '')
+                    return ""
+        elif mime_type == 'text/html':
+            data = part.get('body', {}).get('data', '')
             if data:
                 try:
                     html = base64.urlsafe_b64decode(data).decode('utf-8')
-                    # Simple HTML to text conversion
-                    text = re.sub(r'<[^>]+>', '', html)
-                    return text
+                    return html_to_text(html)
                 except Exception:
-                    pass
-        
-        # Check if this is a multipart message
-        elif 'parts' in payload:
-            for part in payload['parts']:
-                result = extract_from_part(part)
+                    return ""
+        elif 'parts' in part:
+            for subpart in part['parts']:
+                result = self._extract_from_part(subpart)
                 if result:
-                    body = result
-                    break
-        
-        return body or payload.get('snippet', '')
+                    return result
+        return ""
 
-    def post_to_slack(self, message_data: Dict[str, Any]) -> bool:
-        """Post message to Slack via webhook."""
-        try:
-            # Create Gmail link
-            gmail_link = f"https://mail.google.com/mail/u/0/#inbox/{message_data['thread_id']}"
-            
-            # Format message
-            text = f"📧 New Email: {message_data['subject']}"
-            
-            blocks = [
-                {
-                    "type": "header",
-                    "text": {
-                        "type": "plain_text",
-                        "text": f"📧 {message_data['subject']}"
-                    }
-                },
-                {
-                    "type": "section",
-                    "fields": [
-                        {
-                            "type": "mrkdwn",
-                            "text": f"*From:*\n{message_data['sender']}"
-                        },
-                        {
-                            "type": "mrkdwn",
-                            "text": f"*Date:*\n{message_data['date']}"
-                        }
-                    ]
-                },
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": f"*Query:* `{self.gmail_query}`"
-                    }
+    def build_slack_payload(self, message_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the Slack Block Kit payload for a message."""
+        # Create Gmail link
+        gmail_link = f"https://mail.google.com/mail/u/0/#inbox/{message_data['thread_id']}"
+        
+        # Format message
+        text = f"📧 New Email: {message_data['subject']}"
+        
+        blocks = [
+            {
+                "type": "header",
+                "text": {
+                    "type": "plain_text",
+                    "text": f"📧 {message_data['subject']}"
                 }
-            ]
-            
-            # Add body preview
-            if message_data['body']:
-                blocks.append({
-                    "type": "section",
-                    "text": {
+            },
+            {
+                "type": "section",
+                "fields": [
+                    {
                         "type": "mrkdwn",
-                        "text": f"*Preview:*\n```{message_data['body']}```"
-                    }
-                })
-            
-            # Add Gmail button
-            blocks.append({
-                "type": "actions",
-                "elements": [
+                        "text": f"*From:*\n{message_data['sender']}"
+                    },
                     {
-                        "type": "button",
-                        "text": {
-                            "type": "plain_text",
-                            "text": "Open in Gmail"
-                        },
-                        "url": gmail_link,
-                        "action_id": "open_gmail"
+                        "type": "mrkdwn",
+                        "text": f"*Date:*\n{message_data['date']}"
                     }
                 ]
+            },
+            self._query_block
+        ]
+        
+        # Add body preview (the full body is kept on message_data for Record ID extraction)
+        preview = message_data['body']
+        if preview and not self.return_full_body:
+            preview = preview[:BODY_PREVIEW_LIMIT]
+        if preview:
+            blocks.append({
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": f"*Preview:*\n```{preview}```"
+                }
             })
-            
-            payload = {
-                "text": text,
-                "channel": self.slack_channel,
-                "username": self.slack_username,
-                "blocks": blocks
-            }
-            
-            response = requests.post(self.slack_webhook_url, json=payload)
+        
+        # Add Gmail button
+        blocks.append({
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Open in Gmail"
+                    },
+                    "url": gmail_link,
+                    "action_id": "open_gmail"
+                }
+            ]
+        })
+        
+        return {
+            **self._slack_base,
+            "text": text,
+            "blocks": blocks
+        }
+
+    async def post_to_slack_async(self, client: httpx.AsyncClient, message_data: Dict[str, Any]) -> bool:
+        """Post message to Slack via webhook."""
+        try:
+            data = orjson.dumps(self.build_slack_payload(message_data))
+            response = await client.post(self.slack_webhook_url, content=data, headers=JSON_HEADERS)
             
             if response.status_code == 200:
                 logger.info("Message posted to Slack successfully")
@@ -599,32 +947,44 @@ class GmailSlackMonitor:
             logger.error(f"Error posting to Slack: {e}")
             return False
 
-    def start_polling(self):
-        """Start the Gmail polling loop."""
+    def _new_slack_client(self) -> httpx.AsyncClient:
+        """Create a keep-alive HTTP/2 client for Slack webhook posts."""
+        return httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20),
+            timeout=10
+        )
+
+    async def start_polling_async(self):
+        """Start the Gmail polling loop on the asyncio event loop."""
         logger.info(f"Starting Gmail polling every {self.poll_interval} seconds")
-        while True:
+        async with self._new_slack_client() as client:
+            self._slack_client = client
             try:
-                self.poll_gmail()
-                time.sleep(self.poll_interval)
-            except KeyboardInterrupt:
-                logger.info("Polling stopped by user")
-                break
-            except Exception as e:
-                logger.error(f"Error in polling loop: {e}")
-                time.sleep(self.poll_interval)
+                while True:
+                    try:
+                        await self.poll_gmail_async()
+                    except Exception as e:
+                        logger.error(f"Error in polling loop: {e}")
+                    await asyncio.sleep(self._next_poll_delay())
+            finally:
+                self._slack_client = None
 
 # Initialize the monitor
 monitor = GmailSlackMonitor()
 
-# Flask app for health checks
-app = Flask(__name__)
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson."""
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
 
-@app.route('/health')
-def health():
+# ASGI app for health checks
+async def health(request):
     """Health check endpoint."""
     gmail_status = 'connected' if monitor.gmail_service else 'disconnected'
     
-    return jsonify({
+    return ORJSONResponse({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
         'timezone': monitor.timezone,
@@ -634,24 +994,23 @@ def health():
         'gmail_service': gmail_status
     })
 
-@app.route('/sweep')
-def sweep():
+async def sweep(request):
     """Manual fresh sweep endpoint for immediate processing."""
     try:
         logger.info("Manual sweep requested via /sweep endpoint")
         
         # Check if Gmail service is available
         if not monitor.gmail_service:
-            return jsonify({
+            return ORJSONResponse({
                 'status': 'error',
                 'message': 'Gmail service not available',
                 'timestamp': datetime.now().isoformat()
-            }), 503
+            }, status_code=503)
         
         # Perform a fresh sweep
-        monitor.poll_gmail()
+        await monitor.poll_gmail_async()
         
-        return jsonify({
+        return ORJSONResponse({
             'status': 'success',
             'message': 'Fresh sweep completed',
             'timestamp': datetime.now().isoformat(),
@@ -660,35 +1019,51 @@ def sweep():
         
     except Exception as e:
         logger.error(f"Error during manual sweep: {e}")
-        return jsonify({
+        return ORJSONResponse({
             'status': 'error',
             'message': f'Sweep failed: {str(e)}',
             'timestamp': datetime.now().isoformat()
-        }), 500
+        }, status_code=500)
 
-def main():
-    """Main function to start the service."""
+app = Starlette(routes=[
+    Route('/health', health),
+    Route('/sweep', sweep)
+])
+
+async def serve_http():
+    """Serve the ASGI app with uvicorn on the current event loop."""
+    port = int(os.getenv('PORT', '10000'))
+    config = uvicorn.Config(app, host='0.0.0.0', port=port, log_config=None)
+    await uvicorn.Server(config).serve()
+
+async def main_async():
+    """Start the service components for the configured mode."""
     mode = os.getenv('MODE', 'combined').lower()
     
     if mode == 'server':
         logger.info("Starting in server mode")
-        port = int(os.getenv('PORT', '10000'))
-        serve(app, host='0.0.0.0', port=port)
+        await serve_http()
     elif mode == 'worker':
         logger.info("Starting in worker mode")
-        monitor.start_polling()
+        await monitor.start_polling_async()
     elif mode == 'combined':
         logger.info("Starting in combined mode")
-        # Start polling in a separate thread
-        polling_thread = threading.Thread(target=monitor.start_polling, daemon=True)
-        polling_thread.start()
-        
-        # Start Flask server in main thread
-        port = int(os.getenv('PORT', '10000'))
-        serve(app, host='0.0.0.0', port=port)
+        # Run polling as a task on the same event loop as the server
+        polling_task = asyncio.create_task(monitor.start_polling_async())
+        try:
+            await serve_http()
+        finally:
+            polling_task.cancel()
     else:
         logger.error(f"Unknown mode: {mode}")
         return
 
+def main():
+    """Main function to start the service."""
+    try:
+        asyncio.run(main_async())
+    except KeyboardInterrupt:
+        logger.info("Service stopped by user")
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -6,12 +6,12 @@ This shows exactly how Forth cancellation emails will appear in Slack.
 
 import json
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
 
 def create_forth_cancellation_message():
     """Create a realistic Forth CRM cancellation message for testing."""
     # Get current time in Manila timezone
-    tz = pytz.timezone('Asia/Manila')
+    tz = ZoneInfo('Asia/Manila')
     current_time = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S %Z')
     
     return {
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Offline check of the pooled Gmail API transport on a stubbed session
+"""
+
+import re
+import sys
+import json
+from unittest import mock
+
+import requests
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+from app import AuthorizedSessionHttp
+
+BOUNDARY = 'batch_test_boundary'
+
+def make_response(status, body, content_type):
+    """Build a requests.Response like the ones AuthorizedSession returns"""
+    response = requests.Response()
+    response.status_code = status
+    response._content = body
+    response.headers['Content-Type'] = content_type
+    # Gmail sends gzip bodies, so these describe the compressed bytes rather than the decoded content
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Content-Length'] = str(len(body) // 3)
+    return response
+
+def fake_request(method, uri, data=None, headers=None, **kwargs):
+    """Answer Gmail API calls without touching the network"""
+    if uri.endswith('/batch'):
+        # Echo each part's Content-ID back as the batch API does, with a message for each
+        body = data.decode() if isinstance(data, bytes) else data
+        parts = []
+        for content_id in re.findall(r'Content-ID: <([^>]+)>', body):
+            message_id = content_id.rsplit('+', 1)[-1].strip()
+            message = json.dumps({'id': message_id, 'snippet': f'snippet {message_id}'})
+            parts.append(
+                f'--{BOUNDARY}\r\n'
+                'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                'HTTP/1.1 200 OK\r\n'
+                'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+                f'{message}\r\n'
+            )
+        payload = (''.join(parts) + f'--{BOUNDARY}--\r\n').encode()
+        return make_response(200, payload, f'multipart/mixed; boundary={BOUNDARY}')
+
+    payload = json.dumps({'messages': [{'id': 'm1'}, {'id': 'm2'}], 'resultSizeEstimate': 2}).encode()
+    return make_response(200, payload, 'application/json; charset=UTF-8')
+
+def build_service():
+    """Build the Gmail service the way the app does, over a stubbed session"""
+    http = AuthorizedSessionHttp(Credentials(token='test-token'))
+    http.session.request = mock.Mock(side_effect=fake_request)
+    return build('gmail', 'v1', http=http, static_discovery=True), http
+
+def test_list_call():
+    """Test a single messages.list call"""
+    print("🔍 Testing messages.list over the transport...")
+    try:
+        service, http = build_service()
+        results = service.users().messages().list(userId='me', maxResults=5).execute()
+        message_ids = [m['id'] for m in results.get('messages', [])]
+        if message_ids != ['m1', 'm2'] or http.session.request.call_count != 1:
+            print(f"❌ Unexpected list result: {results}")
+            return False
+
+        # The transport must describe the decoded body it hands back, like httplib2 does
+        resp, content = http.request('https://gmail.googleapis.com/gmail/v1/users/me/messages')
+        if 'content-encoding' in resp or resp['content-length'] != str(len(content)):
+            print(f"❌ Response headers do not match the decoded body: {dict(resp)}")
+            return False
+        print(f"✅ List call working! Got {len(message_ids)} messages")
+        return True
+
+    except Exception as e:
+        print(f"❌ List call error: {e}")
+        return False
+
+def test_batch_call():
+    """Test a batch of messages.get calls"""
+    print("\n🔍 Testing batched messages.get over the transport...")
+    try:
+        service, http = build_service()
+        details = {}
+        errors = []
+
+        def on_message_fetched(request_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+            else:
+                details[request_id] = response
+
+        batch = service.new_batch_http_request(callback=on_message_fetched)
+        for message_id in ('m1', 'm2'):
+            batch.add(service.users().messages().get(userId='me', id=message_id, format='full'),
+                      request_id=message_id)
+        batch.execute()
+
+        if errors or sorted(details) != ['m1', 'm2'] or details['m2']['id'] != 'm2':
+            print(f"❌ Unexpected batch result: {details} {errors}")
+            return False
+        if http.session.request.call_count != 1:
+            print(f"❌ Batch used {http.session.request.call_count} requests instead of one")
+            return False
+        print(f"✅ Batch call working! Got {len(details)} messages in one request")
+        return True
+
+    except Exception as e:
+        print(f"❌ Batch call error: {e}")
+        return False
+
+def main():
+    """Run all tests"""
+    print("🚀 Testing Gmail API Transport (offline)")
+    print("=" * 50)
+
+    list_ok = test_list_call()
+    batch_ok = test_batch_call()
+
+    print("\n" + "=" * 50)
+    print("📊 TEST RESULTS:")
+    print(f"List Call: {'✅ PASS' if list_ok else '❌ FAIL'}")
+    print(f"Batch Call: {'✅ PASS' if batch_ok else '❌ FAIL'}")
+
+    if list_ok and batch_ok:
+        print("\n🎉 ALL TESTS PASSED! Gmail transport is working!")
+        return 0
+    else:
+        print("\n⚠️  Some tests failed.")
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
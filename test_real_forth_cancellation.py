@@ -7,12 +7,12 @@ from the screenshot you provided. This will show you exactly how it will look.
 import requests
 import json
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
 
 def create_real_forth_cancellation_message():
     """Create the exact message from your screenshot."""
     # Get current time in Manila timezone
-    tz = pytz.timezone('Asia/Manila')
+    tz = ZoneInfo('Asia/Manila')
     current_time = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S %Z')
     
     return {
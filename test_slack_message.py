@@ -6,7 +6,6 @@ This shows you exactly how the message will be formatted in Slack.
 
 import json
 from datetime import datetime
-import pytz
 
 def create_sample_message():
     """Create a sample Gmail message for testing."""
@@ -8,12 +8,12 @@ import requests
 import json
 import os
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
 
 def create_test_message():
     """Create a test message for Slack."""
     # Get current time in Manila timezone
-    tz = pytz.timezone('Asia/Manila')
+    tz = ZoneInfo('Asia/Manila')
     current_time = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S %Z')
     
     return {
@@ -7,12 +7,12 @@ This will show us exactly what's being sent to Slack.
 import requests
 import json
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
 
 def create_real_message_with_body():
     """Create a message with real body content from the debug output."""
     # Get current time in Manila timezone
-    tz = pytz.timezone('Asia/Manila')
+    tz = ZoneInfo('Asia/Manila')
     current_time = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S %Z')
     
     return {